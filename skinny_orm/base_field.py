@@ -1,48 +1,59 @@
-from typing import List
+from typing import Any, NamedTuple, Union
 
 
-class Comparator:
-    def __init__(self, field_name, comparator, other):
-        self.field_name = field_name
-        self.comparator = comparator
-        self.other = other
+class Condition(NamedTuple):
+    field_name: str
+    comparator: str
+    other: Any
+    # Parameterized SQL fragment, e.g. 'User.id > ? ', the value is only bound as a param
+    sql: str
+
+    def __and__(self, other) -> 'BoolOp':
+        return BoolOp('and', self, other)
+
+    def __or__(self, other) -> 'BoolOp':
+        return BoolOp('or', self, other)
+
+
+class BoolOp(NamedTuple):
+    op: str
+    left: Union[Condition, 'BoolOp']
+    right: Union[Condition, 'BoolOp']
+
+    def __and__(self, other) -> 'BoolOp':
+        return BoolOp('and', self, other)
+
+    def __or__(self, other) -> 'BoolOp':
+        return BoolOp('or', self, other)
 
 
 class BaseField:
-    def __init__(self, field_name: str):
+    __slots__ = ('field_name', 'sql_fragments')
+    COMPARATORS = ('=', '>', '>=', '<=', '<', '!=')
+
+    def __init__(self, field_name: str, qualified_name: str = None):
         self.field_name = field_name
-        self.comparators: List[Comparator] = []
-        self.and_or_s = []
+        qualified_name = qualified_name or field_name
+        # Built once per field, every condition on it reuses the same SQL text
+        self.sql_fragments = {comparator: f"{qualified_name} {comparator} ? " for comparator in self.COMPARATORS}
+
+    def _condition(self, comparator, other) -> Condition:
+        return Condition(self.field_name, comparator, other, self.sql_fragments[comparator])
 
     def __eq__(self, other):
-        self.comparators.append(Comparator(self.field_name, '=', other))
-        return self
+        return self._condition('=', other)
 
     def __gt__(self, other):
-        self.comparators.append(Comparator(self.field_name, '>', other))
-        return self
+        return self._condition('>', other)
 
     def __ge__(self, other):
-        self.comparators.append(Comparator(self.field_name, '>=', other))
-        return self
+        return self._condition('>=', other)
 
     def __le__(self, other):
-        self.comparators.append(Comparator(self.field_name, '<=', other))
-        return self
+        return self._condition('<=', other)
 
     def __lt__(self, other):
-        self.comparators.append(Comparator(self.field_name, '<', other))
-        return self
+        return self._condition('<', other)
 
     def __ne__(self, other):
-        self.comparators.append(Comparator(self.field_name, '!=', other))
-        return self
-
-    def __and__(self, other):
-        self.comparators.extend(other.comparators)
-        self.and_or_s.append('and')
-        return self
-
-    def __or__(self, other):
-        self.and_or_s.append('or')
-        return self
+        return self._condition('!=', other)
@@ -4,7 +4,8 @@ from abc import ABC, abstractmethod
 class BaseOrm(ABC):
 
     @abstractmethod
-    def __init__(self, connection, create_tables_if_not_exists=True, parse_fields=True):
+    def __init__(self, connection, create_tables_if_not_exists=True, parse_fields=True, tune_for_bulk=False,
+                 bulk_chunk_size=10_000, pragmas=None, result_cache=False, tuning=True):
         ...
 
     @abstractmethod
@@ -23,10 +24,22 @@ class BaseOrm(ABC):
     def all(self, commit=False):
         ...
 
+    @abstractmethod
+    def iter_all(self):
+        ...
+
     @abstractmethod
     def first(self):
         ...
 
+    @abstractmethod
+    def get(self, entity, **field_values):
+        ...
+
+    @abstractmethod
+    def prepare(self):
+        ...
+
     @abstractmethod
     def insert(self, instance, commit=True):
         ...
@@ -44,11 +57,15 @@ class BaseOrm(ABC):
         ...
 
     @abstractmethod
-    def upsert(self, instance, commit=True):
+    def upsert(self, instance, conflict_on, commit=True):
+        ...
+
+    @abstractmethod
+    def bulk_upsert(self, instances, conflict_on, commit=True):
         ...
 
     @abstractmethod
-    def bulk_upsert(self, instances, commit=True):
+    def create_unique_index(self, entity, fields):
         ...
 
     @abstractmethod
@@ -62,3 +79,7 @@ class BaseOrm(ABC):
     @abstractmethod
     def using(self, *args):
         ...
+
+    @abstractmethod
+    def fields(self, entity):
+        ...
@@ -14,3 +14,23 @@ class NotValidEntity(Exception):
     def __init__(self, not_valid_entity):
         msg = f"'{not_valid_entity}' is not a valid Entity to select from"
         super(NotValidEntity, self).__init__(msg)
+
+
+class NotSupportedType(Exception):
+    def __init__(self, field_name, field_type):
+        msg = f"Impossible to create a column for {field_name} of type {field_type}"
+        super(NotSupportedType, self).__init__(msg)
+
+
+class NoUniqueConstraint(Exception):
+    def __init__(self, entity_name, conflict_names):
+        fields = ', '.join(conflict_names)
+        msg = f"{entity_name} has no unique constraint on ({fields}), add one to upsert on these fields " \
+              f"e.g. with orm.create_unique_index({entity_name}, {conflict_names!r})"
+        super(NoUniqueConstraint, self).__init__(msg)
+
+
+class NotValidField(Exception):
+    def __init__(self, entity_name, field_name):
+        msg = f"'{field_name}' is not a field of {entity_name}"
+        super(NotValidField, self).__init__(msg)
@@ -1,10 +1,25 @@
+import sqlite3
+
 from skinny_orm.sqlite_orm import SqliteOrm
 
 
 class Orm:
 
-    def __new__(cls, connection, create_tables_if_not_exists=True, parse_fields=True):
+    def __new__(cls, connection, create_tables_if_not_exists=True, parse_fields=True, tune_for_bulk=False,
+                bulk_chunk_size=10_000, pragmas=None, result_cache=False, tuning=True):
         if 'sqlite3' in str(connection.__class__):
-            return SqliteOrm(connection, create_tables_if_not_exists, parse_fields)
+            return SqliteOrm(connection, create_tables_if_not_exists, parse_fields, tune_for_bulk,
+                             bulk_chunk_size, pragmas, result_cache, tuning)
         else:
             raise NotImplementedError
+
+    @classmethod
+    def connect(cls, database, **orm_kwargs) -> SqliteOrm:
+        """
+        Open a sqlite3 connection converting declared column types in C (e.g. datetimes) and wrap it in an Orm
+        :param database: path of the database file or ':memory:'
+        :param orm_kwargs: passed to Orm
+        :return:
+        """
+        connection = sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        return cls(connection, **orm_kwargs)
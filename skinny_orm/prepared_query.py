@@ -0,0 +1,21 @@
+class PreparedQuery:
+    """
+    A select whose SQL text is built once, calling it again only binds new values for the where clause
+    """
+    __slots__ = ('sql', '_first_sql', '_cursor')
+
+    def __init__(self, connection, sql: str, row_factory):
+        self.sql = sql
+        # With the limit the statement completes after fetchone and does not keep the table locked
+        self._first_sql = f"{sql} limit 1"
+        self._cursor = connection.cursor()
+        self._cursor.row_factory = row_factory
+
+    def __call__(self, *params) -> list:
+        return self._cursor.execute(self.sql, params).fetchall()
+
+    def first(self, *params):
+        return self._cursor.execute(self._first_sql, params).fetchone()
+
+    def close(self):
+        self._cursor.close()
@@ -1,10 +1,37 @@
 import sqlite3
-import dateparser
+from collections import OrderedDict, defaultdict, namedtuple
+from copy import copy
 from datetime import datetime
+from operator import attrgetter
+from types import SimpleNamespace
+from weakref import WeakKeyDictionary, WeakSet
 
-from skinny_orm.base_field import BaseField
+from skinny_orm.base_field import BaseField, BoolOp, Condition
 from skinny_orm.base_orm import BaseOrm
-from skinny_orm.exceptions import ParseError, NotValidComparator, NotValidEntity
+from skinny_orm.exceptions import (ParseError, NotValidComparator, NotValidEntity, NotSupportedType,
+                                    NoUniqueConstraint, NotValidField)
+from skinny_orm.prepared_query import PreparedQuery
+
+EntityMeta = namedtuple('EntityMeta', [
+    'field_names',
+    'field_types',
+    'fields',
+    'attrgetters',
+    'select_sql',
+    'insert_sql',
+    'values_sql',
+    'assignments_sql',
+    'upsert_sqls',
+    'get_sqls',
+    'create_sql',
+    'parsers',
+    'make_row_factory',
+])
+
+# Per-entity metadata, built once on first use instead of on every query
+_ENTITY_META: 'WeakKeyDictionary[type, EntityMeta]' = WeakKeyDictionary()
+# Entities whose class attributes were already replaced by their BaseFields
+_ENTITIES_WITH_FIELDS: 'WeakSet[type]' = WeakSet()
 
 
 class SqliteOrm(BaseOrm):
@@ -12,22 +39,81 @@ class SqliteOrm(BaseOrm):
         int: 'INTEGER',
         str: 'TEXT',
         float: 'REAL',
-        datetime: 'TEXT',
+        # TEXT affinity, the name lets sqlite3 convert the column on connections using PARSE_DECLTYPES
+        datetime: 'TEXT_DT',
+    }
+    STATEMENT_CACHE_SIZE = 128
+    RESULT_CACHE_SIZE = 128
+    # Bulk updates of more rows than this use executemany, the CASE statement would get too long
+    CASE_UPDATE_MAX_ROWS = 100
+    # Lowest SQLITE_MAX_VARIABLE_NUMBER default (sqlite < 3.32), the limit of '?' in one statement
+    MAX_VARIABLES = 999
+    # Applied to database files only, WAL mode is persisted in the file so it is a one time cost
+    DEFAULT_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+    }
+    BULK_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'temp_store': 'MEMORY',
+    }
+    # Added to the defaults unless tuning=False: 64 MiB page cache (RAM used per connection) and 256 MiB of
+    # memory-mapped reads, neither changes durability
+    TUNING_PRAGMAS = {
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
     }
 
-    def __init__(self, connection, create_tables_if_not_exists=True, parse_fields=True):
+    def __init__(self, connection, create_tables_if_not_exists=True, parse_fields=True, tune_for_bulk=False,
+                 bulk_chunk_size=10_000, pragmas=None, result_cache=False, tuning=True):
         self.connection = connection
         self.current_query = None
         self.current_entity = None
         self.current_params = []
         self.current_where = 'where '
-        self.current_update_set = 'set '
+        self.update_set_fields = []
         self.is_delete_query = False
         self.is_update_query = False
         self.is_bulk_update_query = False
         self.parse_fields = parse_fields
         self.create_tables_if_not_exists = create_tables_if_not_exists
         self.update_instances = []
+        self.current_params_getter = None
+        self.bulk_chunk_size = bulk_chunk_size
+        self._stmt_cache: 'OrderedDict[str, sqlite3.Cursor]' = OrderedDict()
+        self.result_cache = result_cache
+        self._result_cache: 'OrderedDict[tuple, list]' = OrderedDict()
+        self._table_versions: 'defaultdict[str, int]' = defaultdict(int)
+        self._known_tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if pragmas is None:
+            self._set_default_pragmas(tuning)
+        else:
+            self.set_pragmas(pragmas)
+        if tune_for_bulk:
+            self.set_pragmas(self.BULK_PRAGMAS)
+
+    def _set_default_pragmas(self, tuning=True):
+        database_file = self.connection.execute("PRAGMA database_list").fetchone()[2]
+        if database_file in ('', ':memory:'):
+            return
+        try:
+            self.set_pragmas(self.DEFAULT_PRAGMAS)
+            if tuning:
+                self.set_pragmas(self.TUNING_PRAGMAS)
+        except sqlite3.Error:
+            # Some VFSes do not support WAL, the defaults are only an optimization
+            pass
+
+    def set_pragmas(self, pragmas: dict):
+        """
+        Run 'PRAGMA key=value' on the connection for every item of pragmas
+        :param pragmas: e.g. {'journal_mode': 'WAL', 'synchronous': 'NORMAL'}
+        :return:
+        """
+        for pragma, value in pragmas.items():
+            self.connection.execute(f"PRAGMA {pragma}={value}")
 
     def select(self, entity) -> BaseOrm:
         self._re_init()
@@ -37,14 +123,22 @@ class SqliteOrm(BaseOrm):
         return self
 
     def where(self, where_clause):
-        base_field: BaseField = where_clause
-        base_field.and_or_s = iter(base_field.and_or_s)
-        for comp in base_field.comparators:
-            self.current_params.append(comp.other)
-            self.current_where += f"{self.current_entity.__name__}.{comp.field_name} {comp.comparator} ? "
-            and_or = next(base_field.and_or_s, None)
-            if and_or is not None:
-                self.current_where += f"{and_or} "
+        parts = [self.current_where]
+        append = parts.append
+        # Iterative preorder walk of the condition tree, strings on the stack are emitted as is
+        stack = [where_clause]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, str):
+                append(node)
+            elif isinstance(node, BoolOp):
+                self._push_operand(stack, node.right, node.op)
+                stack.append(f"{node.op} ")
+                self._push_operand(stack, node.left, node.op)
+            else:
+                self.current_params.append(node.other)
+                append(node.sql)
+        self.current_where = ''.join(parts)
 
         if self.is_update_query:
             self.current_query += f" {self.current_update_set}"
@@ -55,91 +149,137 @@ class SqliteOrm(BaseOrm):
             return self._final()
         return self
 
+    @staticmethod
+    def _push_operand(stack, operand, op):
+        # A nested and/or of another kind keeps its own precedence
+        if isinstance(operand, BoolOp) and operand.op != op:
+            stack.extend((') ', operand, '('))
+        else:
+            stack.append(operand)
+
     def limit(self, row_num: int):
         row_num = int(row_num)
         self.current_query = self.current_query + f" limit {row_num}"
         return self.all()
 
     def all(self, commit=False) -> list:
+        if self.is_delete_query:
+            self._invalidate_results(self.current_entity)
+        elif self.result_cache and not commit:
+            return self._cached_all()
         self.is_delete_query = False
-        cursor = self.connection.cursor()
+        return self._execute_select(commit, self._cached_cursor()).fetchall()
+
+    def _cached_all(self) -> list:
+        """
+        Return the result of the current select from the result cache (LRU of RESULT_CACHE_SIZE results),
+        executing it only the first time. The key holds the version of the table, bumped by every write
+        made through the orm, so writes made directly on the connection are not seen until then.
+        :return: new entities, changing them never changes what the next call returns
+        """
         try:
-            res = cursor.execute(self.current_query, tuple(self.current_params)).fetchall()
-            cursor.close()
-            if commit:
-                self.connection.commit()
-            return [self.current_entity(*self._parse_and_get_new_tuple(r)) for r in res]
-        except sqlite3.OperationalError as e:
-            if self.create_tables_if_not_exists and 'no such table' in str(e):
-                self._create_table(self.current_entity, cursor)
-                return self.all(commit)
-            else:
-                raise e
-        except Exception as e:
-            cursor.close()
-            raise e
+            key = (self.current_query, tuple(self.current_params), self._table_versions[self.current_entity.__name__])
+            cached = self._result_cache.get(key)
+        except TypeError:
+            # Unhashable params, this select can not be cached
+            return self._execute_select(cursor=self._cached_cursor()).fetchall()
+        if cached is not None:
+            self._result_cache.move_to_end(key)
+            return [copy(entity) for entity in cached]
+        result = self._execute_select(cursor=self._cached_cursor()).fetchall()
+        self._result_cache[key] = [copy(entity) for entity in result]
+        if len(self._result_cache) > self.RESULT_CACHE_SIZE:
+            self._result_cache.popitem(last=False)
+        return result
+
+    def _invalidate_results(self, entity):
+        self._table_versions[entity.__name__] += 1
+
+    def iter_all(self):
+        """
+        Like all() but yield the entities while they are fetched instead of building the whole list
+        :return: a generator of entities
+        """
+        return self._iter_and_close(self._execute_select())
 
     def first(self):
-        cursor = self.connection.cursor()
+        # Only run with 'limit 1', current_query keeps the select as written by the caller.
+        # The limit also lets the statement complete, so the cached cursor can be used
+        query = self.current_query
+        self.current_query = f"{query} limit 1"
         try:
-            res = cursor.execute(self.current_query, tuple(self.current_params)).fetchone()
-            if res is None:
-                return None
-            cursor.close()
-            return self.current_entity(*self._parse_and_get_new_tuple(res))
-        except sqlite3.OperationalError as e:
-            if self.create_tables_if_not_exists and 'no such table' in str(e):
-                self._create_table(self.current_entity, cursor)
-                self.first()
-            else:
-                raise e
-        except Exception as e:
-            cursor.close()
-            raise e
+            return self._execute_select(cursor=self._cached_cursor()).fetchone()
+        finally:
+            self.current_query = query
+
+    def get(self, entity, **field_values):
+        """
+        Return the first entity whose fields are equal to field_values (or None), e.g. orm.get(User, id=9001)
+        Same as select(User).where(User.id == 9001).first() without building the query each time
+        :param entity:
+        :param field_values:
+        :return:
+        """
+        self._re_init()
+        meta = self._entity_meta(entity)
+        field_names = tuple(field_values)
+        query = meta.get_sqls.get(field_names)
+        if query is None:
+            for field_name in field_names:
+                if field_name not in meta.field_names:
+                    raise NotValidField(entity.__name__, field_name)
+            conditions = 'and '.join([getattr(meta.fields, field_name).sql_fragments['=']
+                                      for field_name in field_names])
+            where = f" where {conditions}" if conditions else ' '
+            query = meta.get_sqls[field_names] = f"{meta.select_sql}{where}limit 1"
+        self.current_entity = entity
+        self.current_query = query
+        self.current_params = list(field_values.values())
+        return self._execute_select(cursor=self._cached_cursor()).fetchone()
+
+    def prepare(self) -> PreparedQuery:
+        """
+        Build the current select once and return it as a callable taking new values for the where clause
+        e.g. get_user = orm.select(User).where(User.id == 0).prepare() then get_user.first(5)
+        :return:
+        """
+        self._ensure_table(self.current_entity, self._cached_cursor())
+        return PreparedQuery(self.connection, self.current_query, self._entity_row_factory(self.current_entity))
 
     def insert(self, instance, commit=True):
         self._re_init()
-        self.current_query = self._generate_insert_query(instance)
-        self.current_params.extend(self._get_current_params_for_instance(instance))
-        cursor = self.connection.cursor()
-        try:
-            cursor.execute(self.current_query, tuple(self.current_params))
-            if commit:
-                self.connection.commit()
-            cursor.close()
-        except sqlite3.OperationalError as e:
-            if self.create_tables_if_not_exists and 'no such table' in str(e):
-                self._create_table(instance.__class__, cursor)
-                self.insert(instance, commit)
-            else:
-                raise e
-        except Exception as e:
-            cursor.close()
-            raise e
+        meta = self._entity_meta(instance)
+        self.current_query = meta.insert_sql
+        self.current_params = list(meta.attrgetters(instance))
+        self._invalidate_results(instance.__class__)
+        self._execute(instance.__class__, self._cached_cursor(), commit=commit)
 
     def bulk_insert(self, instances, commit=True):
         self._re_init()
         if len(instances) == 0:
             return
 
-        self.current_query = self._generate_insert_query(instances[0])
-        for inst in instances:
-            self.current_params.append(self._get_current_params_for_instance(inst))
-        cursor = self.connection.cursor()
-        try:
-            cursor.executemany(self.current_query, self.current_params)
-            if commit:
-                self.connection.commit()
-            cursor.close()
-        except sqlite3.OperationalError as e:
-            if self.create_tables_if_not_exists and 'no such table' in str(e):
-                self._create_table(instances[0].__class__, cursor)
-                self.bulk_insert(instances, commit)
-            else:
+        meta = self._entity_meta(instances[0])
+        self._invalidate_results(instances[0].__class__)
+        if len(instances) <= self.bulk_chunk_size and len(instances) * len(meta.field_names) <= self.MAX_VARIABLES:
+            # Small batches go in one multi-row VALUES statement, a single prepare and step loop
+            self.current_query = meta.insert_sql + f", {meta.values_sql}" * (len(instances) - 1)
+            self.current_params = [value for instance in instances for value in meta.attrgetters(instance)]
+            # One statement succeeds or fails as a whole, but a binding error leaves the transaction sqlite3
+            # opened for it. Only that empty transaction is closed, never one holding the caller's writes
+            opens_transaction = commit and not self.connection.in_transaction
+            try:
+                self._execute(instances[0].__class__, self._cached_cursor(), commit=commit)
+            except Exception as e:
+                if opens_transaction and self.connection.in_transaction:
+                    self.connection.rollback()
                 raise e
-        except Exception as e:
-            cursor.close()
-            raise e
+            return
+
+        self.current_query = meta.insert_sql
+        self.current_params = instances
+        self.current_params_getter = meta.attrgetters
+        self._execute(instances[0].__class__, self._cached_cursor(), bulk=True, commit=commit)
 
     def update(self, entity_or_instance, commit=True) -> 'SqliteOrm':
         self._re_init()
@@ -163,23 +303,47 @@ class SqliteOrm(BaseOrm):
         self.is_update_query = True
         return self
 
-    def upsert(self, instance, commit=True):
-        raise NotImplementedError
+    def upsert(self, instance, conflict_on, commit=True):
+        """
+        Insert the instance or, if a row with the same conflict_on fields already exists, update it
+        :param instance:
+        :param conflict_on: a field (User.id or 'id') or a sequence of fields identifying a row
+        :param commit:
+        :return:
+        """
+        self._re_init()
+        meta = self._entity_meta(instance)
+        conflict_names = self._conflict_names(conflict_on)
+        self.current_query = self._generate_upsert_query(meta, conflict_names)
+        self.current_params = list(meta.attrgetters(instance))
+        self._execute_upsert(instance.__class__, conflict_names, commit)
 
-    def bulk_upsert(self, instances, commit=True):
-        raise NotImplementedError
+    def bulk_upsert(self, instances, conflict_on, commit=True):
+        self._re_init()
+        if len(instances) == 0:
+            return
+
+        meta = self._entity_meta(instances[0])
+        conflict_names = self._conflict_names(conflict_on)
+        self.current_query = self._generate_upsert_query(meta, conflict_names)
+        self.current_params = instances
+        self.current_params_getter = meta.attrgetters
+        self._execute_upsert(instances[0].__class__, conflict_names, commit, bulk=True)
 
     def set(self, set_clause) -> 'SqliteOrm':
-        comparator = set_clause.comparators[0].comparator
+        condition: Condition = set_clause
+        comparator = condition.comparator
         if comparator != '=':
             raise NotValidComparator
-        add_comma = ', '
-        if self.current_update_set == 'set ':
-            add_comma = ''
-        self.current_update_set += f"{add_comma}{set_clause.field_name} {comparator} ? "
-        self.current_params.append(set_clause.comparators[0].other)
+        self.update_set_fields.append(condition.field_name)
+        self.current_params.append(condition.other)
         return self
 
+    @property
+    def current_update_set(self) -> str:
+        # Built from the set() calls only when the query is assembled
+        return 'set ' + ', '.join([f"{field_name} = ? " for field_name in self.update_set_fields])
+
     def delete(self, entity):
         self._re_init()
         self.current_entity = entity
@@ -191,31 +355,174 @@ class SqliteOrm(BaseOrm):
     def _final(self, bulk=False):
         self.is_delete_query = False
         self.is_update_query = False
-        cursor = self.connection.cursor()
+        self._invalidate_results(self.current_entity)
+        cursor = self._cached_cursor()
         try:
             if bulk:
-                cursor.executemany(self.current_query, self.current_params)
+                self._executemany(cursor)
             else:
                 cursor.execute(self.current_query, self.current_params)
-            self.connection.commit()
-            cursor.close()
+                self.connection.commit()
         except Exception as e:
-            cursor.close()
             raise Exception(f'Woups! => {e}')
 
+    def _execute_select(self, commit=False, cursor=None):
+        """
+        Execute the current query on a cursor (a new one if not given) whose rows are already parsed entities
+        :return: the executed cursor
+        """
+        new_cursor = cursor is None
+        if new_cursor:
+            cursor = self.connection.cursor()
+        cursor.row_factory = self._entity_row_factory(self.current_entity)
+        try:
+            return self._execute(self.current_entity, cursor, commit=commit)
+        except Exception as e:
+            if new_cursor:
+                cursor.close()
+            raise e
+
+    def _cached_cursor(self):
+        """
+        Return the cursor kept for the current query text (LRU of STATEMENT_CACHE_SIZE cursors).
+        Only used by the paths that consume the whole result, iter_all() may leave a statement half
+        read so it keeps its own cursor. Cursors are shared, so an orm must stay in one thread.
+        :return:
+        """
+        cursor = self._stmt_cache.get(self.current_query)
+        if cursor is not None:
+            self._stmt_cache.move_to_end(self.current_query)
+            return cursor
+        cursor = self._stmt_cache[self.current_query] = self.connection.cursor()
+        if len(self._stmt_cache) > self.STATEMENT_CACHE_SIZE:
+            self._stmt_cache.popitem(last=False)[1].close()
+        return cursor
+
+    def _execute(self, entity, cursor, bulk=False, commit=False):
+        """
+        Execute the current query (for every row of current_params when bulk) on the table of entity,
+        creating the table first if it is not known yet
+        :return: the executed cursor
+        """
+        self._ensure_table(entity, cursor)
+        try:
+            return self._execute_current_query(cursor, bulk, commit)
+        except sqlite3.OperationalError as e:
+            if entity.__name__ not in self._known_tables or 'no such table' not in str(e):
+                raise e
+            # The table was dropped behind the orm's back
+            self._known_tables.discard(entity.__name__)
+            self._ensure_table(entity, cursor)
+            return self._execute_current_query(cursor, bulk, commit)
+
+    def _execute_current_query(self, cursor, bulk, commit):
+        if bulk:
+            self._executemany(cursor, commit)
+        else:
+            cursor.execute(self.current_query, self.current_params)
+            if commit:
+                self.connection.commit()
+        return cursor
+
+    def _ensure_table(self, entity, cursor):
+        if entity.__name__ in self._known_tables or not self.create_tables_if_not_exists:
+            return
+        self._create_table(entity, cursor)
+        self._known_tables.add(entity.__name__)
+
+    @staticmethod
+    def _iter_and_close(cursor):
+        try:
+            yield from cursor
+        finally:
+            cursor.close()
+
+    def _executemany(self, cursor, commit=True):
+        """
+        Run the current query for every row of current_params. When committing, the whole batch is
+        wrapped in a single BEGIN IMMEDIATE ... COMMIT (rolled back on error) so it costs one journal sync.
+        :param cursor:
+        :param commit:
+        :return:
+        """
+        if not commit:
+            self._executemany_chunks(cursor)
+            return
+        if self.connection.in_transaction:
+            # Join the transaction left open by a previous commit=False call, a failed batch must not
+            # roll back the writes the caller made before it
+            cursor.execute('SAVEPOINT executemany')
+            try:
+                self._executemany_chunks(cursor)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO executemany')
+                cursor.execute('RELEASE executemany')
+                raise e
+            cursor.execute('RELEASE executemany')
+        else:
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                self._executemany_chunks(cursor)
+            except Exception as e:
+                self.connection.rollback()
+                raise e
+        self.connection.commit()
+
+    def _executemany_chunks(self, cursor):
+        # With a current_params_getter, current_params holds instances and their params are only built
+        # bulk_chunk_size rows at a time
+        if self.current_params_getter is None:
+            cursor.executemany(self.current_query, self.current_params)
+            return
+        for start in range(0, len(self.current_params), self.bulk_chunk_size):
+            chunk = self.current_params[start:start + self.bulk_chunk_size]
+            cursor.executemany(self.current_query, map(self.current_params_getter, chunk))
+
     def using(self, *args):
-        self.current_update_set += ', '.join([f"{field} = ?" for field in self._dataclass_fields(self.current_entity)])
-        self.current_where += ', '.join([f"{arg.field_name} = ?" for arg in args])
-        self.current_query += f" {self.current_update_set} {self.current_where}"
-        for inst in self.update_instances:
-            self.current_params.append(
-                [getattr(inst, field_name) for field_name in self._dataclass_fields(self.current_entity)] + \
-                [getattr(inst, arg.field_name) for arg in args])
-
-        if self.is_bulk_update_query is False:
-            self.current_params = self.current_params[0]
+        meta = self._entity_meta(self.current_entity)
+        arg_names = [arg.field_name for arg in args]
+        if self.is_bulk_update_query and len(arg_names) == 1 and self._fits_case_update(meta, arg_names[0]):
+            return self._case_update(meta, arg_names[0])
+        self.current_where += ' and '.join([f"{arg_name} = ?" for arg_name in arg_names])
+        self.current_query += f" set {meta.assignments_sql} {self.current_where}"
+        getter = _tuple_getter(meta.field_names + tuple(arg_names))
+        if self.is_bulk_update_query:
+            self.current_params = self.update_instances
+            self.current_params_getter = getter
+        else:
+            self.current_params = getter(self.update_instances[0])
         self._final(bulk=self.is_bulk_update_query)
 
+    def _fits_case_update(self, meta: EntityMeta, key_name: str) -> bool:
+        if meta.field_names == (key_name,):
+            # Nothing to set besides the key
+            return False
+        row_count = len(self.update_instances)
+        variables_count = row_count * (2 * len(meta.field_names) + 1)
+        return row_count <= self.CASE_UPDATE_MAX_ROWS and variables_count <= self.MAX_VARIABLES
+
+    def _case_update(self, meta: EntityMeta, key_name: str):
+        """
+        Update all the instances with one statement like
+        'update User set name = CASE id WHEN ? THEN ? WHEN ? THEN ? END, ... where id IN (?, ?)'
+        :param meta:
+        :param key_name:
+        :return:
+        """
+        # Like the executemany path, the last instance of a key wins
+        instances = {getattr(instance, key_name): instance for instance in self.update_instances}
+        when_then = ' '.join(['WHEN ? THEN ?'] * len(instances))
+        updated_fields = [field_name for field_name in meta.field_names if field_name != key_name]
+        assignments = ', '.join([f"{field_name} = CASE {key_name} {when_then} END" for field_name in updated_fields])
+        self.current_query += f" set {assignments} where {key_name} IN ({', '.join(['?'] * len(instances))})"
+        self.current_params = []
+        for field_name in updated_fields:
+            for key, instance in instances.items():
+                self.current_params.append(key)
+                self.current_params.append(getattr(instance, field_name))
+        self.current_params.extend(instances)
+        self._final()
+
     def _generate_select_query(self, entity) -> str:
         """
         Generate query like 'select User.id, User.name, User.age, User.birth, User.percentage from User;'
@@ -223,47 +530,45 @@ class SqliteOrm(BaseOrm):
         :return:
         """
         try:
-            class_name = entity.__name__
-            all_fields_query_string_format = ', '.join([f"{class_name}.{field_name}"
-                                                        for field_name in self._dataclass_fields(entity)])
-            query = f"select {all_fields_query_string_format} from {class_name}"
-            return query
+            return self._entity_meta(entity).select_sql
         except AttributeError:
             raise NotValidEntity(entity)
 
-    def _generate_insert_query(self, instance) -> str:
-        fields = []
-        question_marks = []
-        for field_name, field_inst in self._dataclass_fields(instance).items():
-            fields.append(field_name)
-            question_marks.append('?')
-        joined_fields = ', '.join(fields)
-        joined_question_marks = ', '.join(question_marks)
-        query = f"INSERT INTO {instance.__class__.__name__} ({joined_fields}) VALUES ({joined_question_marks})"
-        return query
-
-    def _get_current_params_for_instance(self, instance) -> list:
-        cur_params = []
-        for field_name, field_inst in self._dataclass_fields(instance).items():
-            cur_params.append(getattr(instance, field_name))
-        return cur_params
+    def fields(self, entity) -> SimpleNamespace:
+        """
+        Return the fields of an entity to build conditions with, e.g. orm.fields(User).id == 3
+        :param entity:
+        :return:
+        """
+        return self._entity_meta(entity).fields
 
     def _create_class_fields(self, entity):
-        for field_name, field in self._dataclass_fields(entity).items():
-            setattr(entity, field_name, BaseField(field_name))
+        # BaseFields are stateless so they are set on the class once and shared by every query
+        if entity in _ENTITIES_WITH_FIELDS:
+            return
+        for field_name, field in vars(self._entity_meta(entity).fields).items():
+            setattr(entity, field_name, field)
+        _ENTITIES_WITH_FIELDS.add(entity)
 
-    def _parse_and_get_new_tuple(self, tuple_obj: tuple) -> tuple:
+    def _entity_row_factory(self, entity):
         if not self.parse_fields:
-            return tuple_obj
+            return lambda cursor, row: entity(*row)
+        # The generic parser is only used to tell which field could not be parsed
+        return self._entity_meta(entity).make_row_factory(
+            entity, lambda row: entity(*self._parse_and_get_new_tuple(row, entity)))
+
+    def _parse_and_get_new_tuple(self, tuple_obj: tuple, entity) -> tuple:
+        meta = self._entity_meta(entity)
         res = []
-        for index, (field_name, field) in enumerate(self._dataclass_fields(self.current_entity).items()):
+        for field_name, field_type, parser, value in zip(meta.field_names, meta.field_types, meta.parsers, tuple_obj):
+            # sqlite3 already returns the right type most of the time
+            if type(value) is field_type:
+                res.append(value)
+                continue
             try:
-                if field.type == datetime:
-                    res.append(dateparser.parse(tuple_obj[index]))
-                    continue
-                res.append(field.type(tuple_obj[index]))
+                res.append(parser(value))
             except (TypeError, ValueError):
-                raise ParseError(field_name=field_name, field_type=field.type)
+                raise ParseError(field_name=field_name, field_type=field_type)
         return tuple(res)
 
     def _re_init(self):
@@ -271,18 +576,182 @@ class SqliteOrm(BaseOrm):
         self.current_entity = None
         self.current_params = []
         self.current_where = 'where '
-        self.current_update_set = 'set '
+        self.update_set_fields = []
         self.is_delete_query = False
         self.is_update_query = False
         self.is_bulk_update_query = False
         self.update_instances = []
+        self.current_params_getter = None
 
-    def _create_table(self, entity, cursor):
-        params = ', '.join([f"{field_name}   {self.PYTHON_TYPES_TO_SQLITE_MAPPING[field.type]}"
-                            for field_name, field in self._dataclass_fields(entity).items()])
-        q = f"""CREATE TABLE "{entity.__name__}"({params});"""
-        cursor.execute(q)
+    def _execute_upsert(self, entity, conflict_names, commit, bulk=False):
+        self._invalidate_results(entity)
+        cursor = self._cached_cursor()
+        try:
+            self._execute(entity, cursor, bulk, commit)
+        except sqlite3.OperationalError as e:
+            if 'ON CONFLICT clause does not match' not in str(e):
+                raise e
+            # ON CONFLICT needs a unique constraint on the conflict fields, the schema is never changed here
+            raise NoUniqueConstraint(entity.__name__, conflict_names) from e
+
+    def create_unique_index(self, entity, fields):
+        """
+        Create (if it does not exist yet) a persistent unique index on fields, the key upsert() needs as conflict_on.
+        Once created, inserting a row with the same fields as another one raises sqlite3.IntegrityError
+        :param entity:
+        :param fields: a field (User.id or 'id') or a sequence of fields
+        :return:
+        """
+        self._re_init()
+        field_names = self._conflict_names(fields)
+        index_name = '_'.join((entity.__name__,) + field_names)
+        self.current_query = f"""CREATE UNIQUE INDEX IF NOT EXISTS "{index_name}" """ \
+                             f"""ON "{entity.__name__}"({', '.join(field_names)})"""
+        self._execute(entity, self._cached_cursor())
 
     @staticmethod
-    def _dataclass_fields(entity_or_instance):
-        return {key: val for key, val in entity_or_instance.__dataclass_fields__.items()}
+    def _conflict_names(conflict_on) -> tuple:
+        if isinstance(conflict_on, (BaseField, str)):
+            conflict_on = (conflict_on,)
+        return tuple(field.field_name if isinstance(field, BaseField) else field for field in conflict_on)
+
+    @staticmethod
+    def _generate_upsert_query(meta: EntityMeta, conflict_names: tuple) -> str:
+        """
+        Generate query like
+        'INSERT INTO User (id, name) VALUES (?, ?) ON CONFLICT (id) DO UPDATE SET name = excluded.name'
+        :param meta:
+        :param conflict_names:
+        :return:
+        """
+        query = meta.upsert_sqls.get(conflict_names)
+        if query is None:
+            updated = [f"{field_name} = excluded.{field_name}"
+                       for field_name in meta.field_names if field_name not in conflict_names]
+            do_clause = f"DO UPDATE SET {', '.join(updated)}" if updated else "DO NOTHING"
+            query = f"{meta.insert_sql} ON CONFLICT ({', '.join(conflict_names)}) {do_clause}"
+            meta.upsert_sqls[conflict_names] = query
+        return query
+
+    def _create_table(self, entity, cursor):
+        meta = self._entity_meta(entity)
+        if meta.create_sql is None:
+            field_name, field = next((field_name, field) for field_name, field in entity.__dataclass_fields__.items()
+                                     if field.type not in self.PYTHON_TYPES_TO_SQLITE_MAPPING)
+            raise NotSupportedType(field_name=field_name, field_type=field.type)
+        cursor.execute(meta.create_sql)
+
+    @classmethod
+    def _entity_meta(cls, entity_or_instance) -> EntityMeta:
+        """
+        Return the cached EntityMeta of a dataclass (or of an instance's class), building it on first use
+        :param entity_or_instance:
+        :return:
+        """
+        if isinstance(entity_or_instance, type):
+            entity = entity_or_instance
+        else:
+            entity = entity_or_instance.__class__
+        meta = _ENTITY_META.get(entity)
+        if meta is None:
+            meta = _ENTITY_META[entity] = _build_entity_meta(entity, cls.PYTHON_TYPES_TO_SQLITE_MAPPING)
+        return meta
+
+
+def _parse_datetime(value) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    # Values written by the orm are ISO formatted, dateparser is only needed for anything else
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        # dateparser is slow to import, only load it when a value actually needs it
+        import dateparser
+        return dateparser.parse(value)
+
+
+def _convert_datetime(value: bytes) -> datetime:
+    return _parse_datetime(value.decode())
+
+
+sqlite3.register_converter('TEXT_DT', _convert_datetime)
+
+_SQLITE_NATIVE_TYPES = (int, float, str, bytes)
+
+
+def _tuple_getter(field_names: tuple):
+    # attrgetter returns a bare value instead of a 1-tuple for a single name
+    if len(field_names) == 1:
+        single_getter = attrgetter(field_names[0])
+        return lambda instance: (single_getter(instance),)
+    return attrgetter(*field_names)
+
+
+def _compile_row_factory_maker(field_types: tuple, parsers: tuple):
+    """
+    Generate a straight-line row factory for the given column parsers, e.g. for (int, datetime):
+        def row_factory(cursor, r):
+            try:
+                return E((r[0] if r[0].__class__ is _p0 else _p0(r[0])), _p1(r[1]))
+            except (TypeError, ValueError):
+                return _fallback(r)
+    The entity is only bound when the returned maker is called so the cache does not keep it alive
+    :param field_types:
+    :param parsers:
+    :return: a function make(E, _fallback) returning the row factory
+    """
+    namespace = {f"_p{index}": parser for index, parser in enumerate(parsers)}
+    args = ', '.join([
+        # sqlite3 already returns these types, the parser only runs (and validates) when it did not
+        f"(r[{index}] if r[{index}].__class__ is _p{index} else _p{index}(r[{index}]))"
+        if field_type in _SQLITE_NATIVE_TYPES else f"_p{index}(r[{index}])"
+        for index, field_type in enumerate(field_types)
+    ])
+    source = (
+        "def make(E, _fallback):\n"
+        "    def row_factory(cursor, r):\n"
+        "        try:\n"
+        f"            return E({args})\n"
+        "        except (TypeError, ValueError):\n"
+        "            return _fallback(r)\n"
+        "    return row_factory\n"
+    )
+    exec(source, namespace)
+    return namespace['make']
+
+
+def _build_entity_meta(entity, sqlite_types: dict) -> EntityMeta:
+    class_name = entity.__name__
+    fields = entity.__dataclass_fields__
+    field_names = tuple(fields)
+    getters = _tuple_getter(field_names)
+    qualified_names = {field_name: f"{class_name}.{field_name}" for field_name in field_names}
+    entity_fields = SimpleNamespace(**{field_name: BaseField(field_name, qualified_name)
+                                       for field_name, qualified_name in qualified_names.items()})
+    select_sql = f"select {', '.join(qualified_names.values())} from {class_name}"
+    values_sql = f"({', '.join(['?'] * len(field_names))})"
+    insert_sql = f"INSERT INTO {class_name} ({', '.join(field_names)}) VALUES {values_sql}"
+    assignments_sql = ', '.join([f"{field_name} = ?" for field_name in field_names])
+    try:
+        columns = ', '.join([f"{field_name}   {sqlite_types[field.type]}" for field_name, field in fields.items()])
+        create_sql = f"""CREATE TABLE IF NOT EXISTS "{class_name}"({columns});"""
+    except KeyError:
+        # Only an error if the orm ever has to create the table
+        create_sql = None
+    parsers = tuple(_parse_datetime if field.type == datetime else field.type for field in fields.values())
+    field_types = tuple(field.type for field in fields.values())
+    return EntityMeta(
+        field_names=field_names,
+        field_types=field_types,
+        fields=entity_fields,
+        attrgetters=getters,
+        select_sql=select_sql,
+        insert_sql=insert_sql,
+        values_sql=values_sql,
+        assignments_sql=assignments_sql,
+        upsert_sqls={},
+        get_sqls={},
+        create_sql=create_sql,
+        parsers=parsers,
+        make_row_factory=_compile_row_factory_maker(field_types, parsers),
+    )
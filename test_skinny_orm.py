@@ -1,10 +1,13 @@
 import unittest
 from dataclasses import dataclass
 from datetime import datetime
+import os
 import sqlite3
+import tempfile
 from typing import List
 
-from skinny_orm.exceptions import ParseError, NotValidComparator, NotValidEntity
+from skinny_orm.exceptions import (ParseError, NotValidComparator, NotValidEntity, NotSupportedType,
+                                    NoUniqueConstraint, NotValidField)
 from skinny_orm.orm import Orm
 
 
@@ -32,13 +35,26 @@ class RockBand:
     name: str
 
 
+@dataclass
+class Tag:
+    id: int
+
+
+@dataclass
+class Village:
+    id: int
+    name: str
+    population: int
+
+
 connection = sqlite3.connect(':memory:')
 orm = Orm(connection)
 
 
 class TestSkinnyOrm(unittest.TestCase):
-    def setUp(self) -> None:
-        self.users = [
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.USERS = (
             User(id=1, name='Naruto', age=13, birth=datetime.now(), percentage=0.99),
             User(id=2, name='Sasuke', age=13, birth=datetime.now(), percentage=0.89),
             User(id=3, name='Sakura', age=13, birth=datetime.now(), percentage=0.79),
@@ -50,9 +66,20 @@ class TestSkinnyOrm(unittest.TestCase):
             User(id=9, name='Tsunade', age=50, birth=datetime.now(), percentage=0.59),
             User(id=10, name='Jiraya', age=50, birth=datetime.now(), percentage=0.59),
             User(id=11, name='Oroshimaru', age=50, birth=datetime.now(), percentage=0.59),
-        ]
-        self.goku = User(id=9001, name='Goku', age=45, birth=datetime.now(), percentage=0.99)
-        self.bra = User(id=50, name='Bra', age=3, birth=datetime.now(), percentage=0.99)
+        )
+        cls.goku = User(id=9001, name='Goku', age=45, birth=datetime.now(), percentage=0.99)
+        cls.bra = User(id=50, name='Bra', age=3, birth=datetime.now(), percentage=0.99)
+
+    def setUp(self) -> None:
+        self.users = list(self.USERS)
+
+    def tearDown(self) -> None:
+        try:
+            with connection:
+                connection.execute('DELETE FROM User')
+        except sqlite3.OperationalError:
+            # The User table was not created by this test
+            pass
 
     def test_simple_insert(self):
         orm.insert(self.goku)
@@ -61,11 +88,64 @@ class TestSkinnyOrm(unittest.TestCase):
         self.assertEqual(goku.name, 'Goku')
         self.assertEqual(goku.age, 45)
 
+    def test_statement_cursor_is_reused(self):
+        orm.insert(self.goku)
+        cursor = orm._stmt_cache[orm.current_query]
+        orm.insert(self.bra)
+        self.assertIs(orm._stmt_cache[orm.current_query], cursor)
+        orm.delete(User).all(commit=True)
+
     def test_bulk_insert(self):
         orm.bulk_insert(self.users)
         users = orm.select(User).all()
         self.assertGreater(len(users), 10)
 
+    def test_select_iter_all(self):
+        orm.delete(User).all(commit=True)
+        orm.bulk_insert(self.users)
+        users = orm.select(User).where(User.age == 13).iter_all()
+        self.assertNotIsInstance(users, list)
+        self.assertEqual(list(users), self.users[:3])
+
+    def test_small_bulk_insert_uses_multi_row_values(self):
+        orm.delete(User).all(commit=True)
+        orm.bulk_insert(self.users[:2])
+        self.assertEqual(orm.current_query, 'INSERT INTO User (id, name, age, birth, percentage) '
+                                            'VALUES (?, ?, ?, ?, ?), (?, ?, ?, ?, ?)')
+        self.assertEqual(orm.select(User).all(), self.users[:2])
+        orm.delete(User).all(commit=True)
+
+    def test_bulk_insert_in_chunks(self):
+        orm.delete(User).all(commit=True)
+        chunked_orm = Orm(connection, bulk_chunk_size=4)
+        chunked_orm.bulk_insert(self.users)
+        self.assertEqual(chunked_orm.select(User).all(), self.users)
+        orm.delete(User).all(commit=True)
+
+    def test_bulk_insert_is_rolled_back_on_error(self):
+        orm.delete(User).all(commit=True)
+        with self.assertRaises(sqlite3.Error):
+            orm.bulk_insert(self.users + [User(id=12, name=object(), age=0, birth=datetime.now(), percentage=0.0)])
+        self.assertFalse(connection.in_transaction)
+        self.assertEqual(orm.select(User).all(), [])
+
+    def test_failed_bulk_keeps_pending_writes(self):
+        orm.insert(self.goku, commit=False)
+        chunked_orm = Orm(connection, bulk_chunk_size=1)
+        with self.assertRaises(sqlite3.Error):
+            chunked_orm.bulk_insert(self.users[:2] + [User(id=12, name=object(), age=0, birth=datetime.now(),
+                                                           percentage=0.0)])
+        self.assertTrue(connection.in_transaction)
+        self.assertEqual(orm.select(User).all(), [self.goku])
+        connection.rollback()
+
+    def test_failed_small_bulk_insert_keeps_pending_writes(self):
+        orm.insert(self.goku, commit=False)
+        with self.assertRaises(sqlite3.Error):
+            orm.bulk_insert([self.bra, User(id=12, name=object(), age=0, birth=datetime.now(), percentage=0.0)])
+        self.assertEqual(orm.select(User).all(), [self.goku])
+        connection.rollback()
+
     def test_simple_select(self):
         orm.bulk_insert(self.users)
         users = orm.select(User).all()
@@ -90,6 +170,36 @@ class TestSkinnyOrm(unittest.TestCase):
             'select User.id, User.name, User.age, User.birth, User.percentage from User')
         self.assertIsInstance(user, User)
 
+    def test_select_first_runs_with_limit(self):
+        orm.insert(self.goku)
+        orm.select(User).where(User.id == 9001).first()
+        limited_query = 'select User.id, User.name, User.age, User.birth, User.percentage from User ' \
+                        'where User.id = ?  limit 1'
+        self.assertIn(limited_query, orm._stmt_cache)
+        orm.delete(User).all(commit=True)
+
+    def test_select_result_cache(self):
+        cached_orm = Orm(connection, result_cache=True)
+        cached_orm.insert(self.goku)
+        self.assertEqual(cached_orm.select(User).all(), [self.goku])
+        # Not written through the orm, so the cached result is still returned
+        with connection:
+            connection.execute("DELETE FROM User")
+        self.assertEqual(cached_orm.select(User).all(), [self.goku])
+        cached_orm.insert(self.bra)
+        self.assertEqual(cached_orm.select(User).all(), [self.bra])
+
+    def test_select_result_cache_returns_copies(self):
+        cached_orm = Orm(connection, result_cache=True)
+        cached_orm.insert(self.goku)
+        cached_orm.select(User).all()[0].name = 'Never saved'
+        cached_orm.select(User).all()[0].name = 'Never saved'
+        self.assertEqual(cached_orm.select(User).all(), [self.goku])
+        # Committing selects are not answered from the cache
+        with connection:
+            connection.execute("DELETE FROM User")
+        self.assertEqual(cached_orm.select(User).all(commit=True), [])
+
     def test_select_if_fields_are_converted(self):
         orm.insert(self.goku)
         goku: User = orm.select(User).where(User.id == self.goku.id).first()
@@ -100,6 +210,18 @@ class TestSkinnyOrm(unittest.TestCase):
         self.assertIsInstance(goku.percentage, float)
         self.assertIsInstance(goku.birth, datetime)
 
+    def test_get(self):
+        orm.bulk_insert(self.users)
+        self.assertEqual(orm.get(User, id=4), self.users[3])
+        self.assertEqual(orm.current_query, 'select User.id, User.name, User.age, User.birth, User.percentage '
+                                            'from User where User.id = ? limit 1')
+        self.assertEqual(orm.get(User, age=50, name='Jiraya'), self.users[9])
+        self.assertIsNone(orm.get(User, id=404))
+
+    def test_get_unknown_field(self):
+        with self.assertRaisesRegex(NotValidField, "'nope' is not a field of User"):
+            orm.get(User, nope=1)
+
     def test_select_user_not_exist(self):
         user = orm.select(User).where(User.name == "I don't exist").first()
         self.assertIsNone(user)
@@ -117,6 +239,61 @@ class TestSkinnyOrm(unittest.TestCase):
             'from User where User.id > ? and User.age < ? ')
         self.assertIsInstance(users[0], User)
 
+    def test_select_with_nested_and_or_where_clause(self):
+        orm.delete(User).all(commit=True)
+        orm.bulk_insert(self.users)
+        users = orm.select(User).where((User.age == 50) & ((User.name == 'Jiraya') | (User.name == 'Tsunade'))).all()
+        self.assertEqual(
+            orm.current_query,
+            'select User.id, User.name, User.age, User.birth, User.percentage '
+            'from User where User.age = ? and (User.name = ? or User.name = ? ) ')
+        self.assertEqual([user.name for user in users], ['Tsunade', 'Jiraya'])
+
+    def test_conditions_do_not_leak_between_queries(self):
+        orm.bulk_insert(self.users)
+        orm.select(User).where(User.id == 1).first()
+        user = orm.select(User).where(User.id == 2).first()
+        self.assertEqual(orm.current_params, [2])
+        self.assertEqual(user.id, 2)
+
+    def test_prepared_select(self):
+        orm.delete(User).all(commit=True)
+        orm.bulk_insert(self.users)
+        select_by_age = orm.select(User).where(User.age == 0).prepare()
+        self.assertEqual(select_by_age.sql, 'select User.id, User.name, User.age, User.birth, User.percentage '
+                                            'from User where User.age = ? ')
+        self.assertEqual(select_by_age(13), self.users[:3])
+        self.assertEqual(select_by_age.first(27), self.users[3])
+        self.assertEqual(select_by_age(99), [])
+        select_by_age.close()
+        orm.delete(User).all(commit=True)
+
+    def test_prepared_first_does_not_lock_the_table(self):
+        own_connection = sqlite3.connect(':memory:')
+        own_orm = Orm(own_connection)
+        own_orm.bulk_insert([Animal(1, 'Kurama'), Animal(2, 'Kurama')])
+        select_by_name = own_orm.select(Animal).where(Animal.name == '').prepare()
+        self.assertEqual(select_by_name.first('Kurama'), Animal(1, 'Kurama'))
+        own_connection.execute('drop table Animal')
+        own_connection.close()
+
+    def test_select_with_orm_fields(self):
+        orm.delete(User).all(commit=True)
+        orm.bulk_insert(self.users)
+        fields = orm.fields(User)
+        self.assertIs(orm.fields(User), fields)
+        users = orm.select(User).where(fields.age > 30).all()
+        self.assertEqual([user.name for user in users], ['Minato', 'Tsunade', 'Jiraya', 'Oroshimaru'])
+        self.assertIs(User.age, fields.age)
+        orm.delete(User).all(commit=True)
+
+    def test_conditions_have_no_instance_dict(self):
+        orm.select(User)
+        condition = (User.id > 5) & (User.age < 7)
+        self.assertFalse(hasattr(condition, '__dict__'))
+        self.assertFalse(hasattr(condition.left, '__dict__'))
+        self.assertFalse(hasattr(User.id, '__dict__'))
+
     def test_delete(self):
         orm.insert(self.goku)
         orm.delete(User).where(User.id == 9001)
@@ -169,6 +346,10 @@ class TestSkinnyOrm(unittest.TestCase):
         animals = orm.select(Animal).first()
         connection.execute('drop table Animal')
 
+    def test_existing_tables_are_known_on_init(self):
+        orm.select(User).all()
+        self.assertIn('User', Orm(connection)._known_tables)
+
     def test_select_table_that_does_not_exists_raise_exception(self):
         orm = Orm(connection, create_tables_if_not_exists=False)
         with self.assertRaises(sqlite3.OperationalError):
@@ -212,6 +393,37 @@ class TestSkinnyOrm(unittest.TestCase):
         result = orm.select(User).all()
         self.assertEqual(users, result[:3])
 
+    def test_update_using_several_fields(self):
+        orm.delete(User).all(commit=True)
+        orm.bulk_insert(self.users)
+        sasuke = User(id=2, name='Sasuke', age=16, birth=self.users[1].birth, percentage=0.9)
+        orm.update(sasuke).using(User.id, User.name)
+        self.assertEqual(orm.current_query, 'update User  set id = ?, name = ?, age = ?, birth = ?, percentage = ? '
+                                            'where id = ? and name = ?')
+        self.assertEqual(orm.select(User).where(User.id == 2).first(), sasuke)
+        orm.delete(User).all(commit=True)
+
+    def test_bulk_update_uses_a_single_case_statement(self):
+        orm.bulk_insert(self.users)
+        users = [
+            User(id=1, name='Naruto', age=16, birth=self.users[0].birth, percentage=1.0),
+            User(id=2, name='Sasuke', age=17, birth=self.users[1].birth, percentage=1.0),
+        ]
+        orm.bulk_update(users).using(User.id)
+        self.assertEqual(
+            orm.current_query,
+            'update User  set name = CASE id WHEN ? THEN ? WHEN ? THEN ? END, '
+            'age = CASE id WHEN ? THEN ? WHEN ? THEN ? END, '
+            'birth = CASE id WHEN ? THEN ? WHEN ? THEN ? END, '
+            'percentage = CASE id WHEN ? THEN ? WHEN ? THEN ? END where id IN (?, ?)')
+        self.assertEqual(orm.select(User).all(), users + self.users[2:])
+
+    def test_bulk_update_of_key_only_entity(self):
+        orm.bulk_insert([Tag(1), Tag(2)])
+        orm.bulk_update([Tag(1), Tag(2)]).using(Tag.id)
+        self.assertEqual(orm.current_query, 'update Tag  set id = ? where id = ?')
+        self.assertEqual(orm.select(Tag).all(), [Tag(1), Tag(2)])
+
     def test_readme_example(self):
         users = [
             User(id=1, name='Naruto', age=15, birth=datetime(2020, 1, 1, 0, 0), percentage=9.99),
@@ -251,3 +463,101 @@ class TestSkinnyOrm(unittest.TestCase):
 
         test = orm.select(TestTable).all()
         self.assertEqual(test, [])
+
+    def test_entity_meta_is_cached(self):
+        orm.select(User).all()
+        meta = orm._entity_meta(User)
+        self.assertIs(orm._entity_meta(self.goku), meta)
+        self.assertEqual(meta.field_names, ('id', 'name', 'age', 'birth', 'percentage'))
+        self.assertEqual(meta.select_sql, 'select User.id, User.name, User.age, User.birth, User.percentage from User')
+        self.assertEqual(meta.attrgetters(self.goku), (9001, 'Goku', 45, self.goku.birth, 0.99))
+
+    def test_default_pragmas_on_database_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_connection = sqlite3.connect(os.path.join(tmp_dir, 'default.db'))
+            Orm(file_connection)
+            self.assertEqual(file_connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(file_connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+            self.assertEqual(file_connection.execute('PRAGMA cache_size').fetchone()[0], -65536)
+            file_connection.close()
+
+            not_tuned_connection = sqlite3.connect(os.path.join(tmp_dir, 'not_tuned.db'))
+            Orm(not_tuned_connection, tuning=False)
+            self.assertEqual(not_tuned_connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertNotEqual(not_tuned_connection.execute('PRAGMA cache_size').fetchone()[0], -65536)
+            self.assertEqual(not_tuned_connection.execute('PRAGMA temp_store').fetchone()[0], 0)
+            not_tuned_connection.close()
+
+            untouched_connection = sqlite3.connect(os.path.join(tmp_dir, 'untouched.db'))
+            Orm(untouched_connection, pragmas={})
+            self.assertEqual(untouched_connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+            untouched_connection.close()
+
+    def test_tune_for_bulk_sets_pragmas(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_connection = sqlite3.connect(os.path.join(tmp_dir, 'bulk.db'))
+            file_orm = Orm(file_connection, tuning=False, tune_for_bulk=True)
+            self.assertEqual(file_connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(file_connection.execute('PRAGMA synchronous').fetchone()[0], 1)
+            # MEMORY, not set by the defaults without tuning
+            self.assertEqual(file_connection.execute('PRAGMA temp_store').fetchone()[0], 2)
+            file_orm.bulk_insert(self.users)
+            self.assertEqual(len(file_orm.select(User).all()), len(self.users))
+            file_connection.close()
+
+    def test_select_parses_non_iso_datetime(self):
+        orm.insert(self.goku)
+        connection.execute('insert into User (id, name, age, birth, percentage) '
+                           "values (8000, 'Vegeta', 48, 'January 12, 2012 10:00 PM', 0.98)")
+        vegeta: User = orm.select(User).where(User.id == 8000).first()
+        self.assertEqual(vegeta.birth, datetime(2012, 1, 12, 22, 0))
+        orm.delete(User).where(User.id == 8000)
+
+    def test_upsert(self):
+        orm.create_unique_index(Village, 'id')
+        orm.upsert(Village(id=1, name='Konoha', population=1000), conflict_on='id')
+        orm.select(Village).all()
+        orm.upsert(Village(id=1, name='Konoha', population=2000), conflict_on=Village.id)
+        self.assertEqual(orm.select(Village).all(), [Village(id=1, name='Konoha', population=2000)])
+        connection.execute('drop table Village')
+
+    def test_upsert_does_not_change_the_schema(self):
+        own_connection = sqlite3.connect(':memory:')
+        own_orm = Orm(own_connection)
+        # Also when the table was just created by the orm
+        with self.assertRaisesRegex(NoUniqueConstraint, r"create_unique_index\(Village, \('id',\)\)"):
+            own_orm.upsert(Village(id=1, name='Konoha', population=1000), conflict_on='id')
+        self.assertEqual(own_connection.execute("select name from sqlite_master where type='index'").fetchall(), [])
+        own_connection.close()
+
+    def test_bulk_upsert(self):
+        orm.bulk_insert([Village(id=1, name='Konoha', population=1000), Village(id=2, name='Suna', population=500)])
+        orm.create_unique_index(Village, ['id'])
+        orm.bulk_upsert([Village(id=2, name='Suna', population=600), Village(id=3, name='Kiri', population=700)],
+                        conflict_on=['id'])
+        self.assertEqual(
+            orm.current_query,
+            'INSERT INTO Village (id, name, population) VALUES (?, ?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET name = excluded.name, population = excluded.population')
+        self.assertEqual(orm.select(Village).all(), [Village(id=1, name='Konoha', population=1000),
+                                                     Village(id=2, name='Suna', population=600),
+                                                     Village(id=3, name='Kiri', population=700)])
+        connection.execute('drop table Village')
+
+    def test_create_table_with_not_supported_type_raise_exception(self):
+        @dataclass
+        class Scroll:
+            name: str
+            is_forbidden: bool
+
+        with self.assertRaises(NotSupportedType):
+            orm.insert(Scroll(name='Scroll of Seals', is_forbidden=True))
+
+    def test_datetime_converted_by_sqlite_with_parse_decltypes(self):
+        decltypes_orm = Orm.connect(':memory:')
+        decltypes_connection = decltypes_orm.connection
+        decltypes_orm.insert(self.goku)
+        row = decltypes_connection.execute('select birth from User').fetchone()
+        self.assertIsInstance(row[0], datetime)
+        self.assertEqual(decltypes_orm.select(User).first(), self.goku)
+        decltypes_connection.close()